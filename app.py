@@ -1,8 +1,11 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import math
+import xlsxwriter
+from flash_kernels import compute_all
 from io import BytesIO
-from datetime import datetime, timedelta
+from datetime import datetime
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -63,6 +66,11 @@ def _to_float(v):
     except:
         return 0.0
 
+def _as_datetime(s):
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return s
+    return pd.to_datetime(s, cache=True)
+
 def _match_desc(raw):
     nrm = _n(raw)
     if nrm in _DESC_NORM:
@@ -76,18 +84,14 @@ def _match_desc(raw):
 # STEP 1a — Load Master lookup  →  { HPPN: {MOQ, Iprice} }
 # =============================================================================
 
-def _load_master(xl):
+def _master_frame(raw):
     """
-    Master sheet layout (row 0 = header):
-      col 0 = HPPN
-      col 1 = Cost (Iprice)   ← "Cost as of …"
-      col 3 = MOQ
-    Returns { hppn_str: {"MOQ": float, "Iprice": float} }
+    Master sheet (header-less raw frame) with its header row promoted to the
+    column names; the header is the first of the top rows containing 'HPPN'.
+    Returns a DataFrame or None.
     """
-    sheet = _find_sheet(xl.sheet_names, ["Master", "MASTER", "master"])
-    if not sheet:
-        return {}
-    raw = xl.parse(sheet, header=None)
+    if raw is None:
+        return None
 
     # Find header row (contains 'HPPN')
     hrow = 0
@@ -101,6 +105,20 @@ def _load_master(xl):
                for i, v in enumerate(raw.iloc[hrow])]
     data = raw.iloc[hrow+1:].reset_index(drop=True)
     data.columns = headers
+    return data
+
+
+def _load_master(data):
+    """
+    Master sheet layout (row 0 = header), passed in from _master_frame:
+      col 0 = HPPN
+      col 1 = Cost (Iprice)   ← "Cost as of …"
+      col 3 = MOQ
+    Returns { hppn_str: {"MOQ": float, "Iprice": float} }
+    """
+    if data is None:
+        return {}
+    headers = list(data.columns)
 
     def _col(kws):
         for col in headers:
@@ -167,19 +185,17 @@ def _get_tdos_target_date(sdos_dates, first_data_date):
     return max(candidates)
 
 
-def _load_sdos(xl, first_data_date):
+def _load_sdos(raw, first_data_date):
     """
     Returns { Product_ID: TDOS_days } using the quarter-end TDOS logic.
-    SDOS layout (row 2 = header):
+    SDOS layout (row 2 = header), passed in header-less:
       col 0  = Location ID
       col 3  = Product ID
       col 8  = KeyFigure label ("Safety Days of Supply")
       col 9+ = weekly date columns
     """
-    sheet = _find_sheet(xl.sheet_names, ["SDOS", "sdos"])
-    if not sheet:
+    if raw is None:
         return {}
-    raw  = xl.parse(sheet, header=None)
 
     # Collect all date columns (row 2 header, col 9+)
     sdos_dates = []
@@ -231,20 +247,27 @@ def _load_sdos(xl, first_data_date):
 #   Rows 14-15: blank separator
 # =============================================================================
 
-def _parse_sheet_new(xl, sheet_name, master_lut, sdos_lut):
+def _parse_sheet_new(raw, master_lut, sdos_lut):
     """
-    Parse new-format (weekly upload) MPA sheet into a tidy long DataFrame.
+    Parse new-format (weekly upload) MPA sheet (header-less raw frame) into a
+    tidy long DataFrame.
     Columns: MPA, Part Number, Date, MOQ, TDOS, n, Onhand, Iprice,
              <12 demand/supply cols>
     """
-    raw = xl.parse(sheet_name, header=None)
-
     # Header rows: col0 == 'MPA'
     header_rows = [r for r in range(len(raw))
                    if str(raw.iloc[r, 0]).strip() == "MPA"]
     if not header_rows:
         return pd.DataFrame()
 
+    # Normalised-key indexes for the fuzzy fallback lookups (first key wins)
+    master_by_n = {}
+    for k, v in master_lut.items():
+        master_by_n.setdefault(_n(k), v)
+    sdos_by_n = {}
+    for k, v in sdos_lut.items():
+        sdos_by_n.setdefault(_n(k), v)
+
     records = []
     for hr in header_rows:
         # Date columns: col5+, real dates with year >= 2020
@@ -309,7 +332,7 @@ def _parse_sheet_new(xl, sheet_name, master_lut, sdos_lut):
             moq    = master_lut[pn]["MOQ"]
             iprice = master_lut[pn]["Iprice"]
         else:
-            hit = next((v for k, v in master_lut.items() if _n(k) == pn_n), None)
+            hit = master_by_n.get(pn_n)
             moq    = hit["MOQ"]    if hit else 0.0
             iprice = hit["Iprice"] if hit else 0.0
 
@@ -317,7 +340,7 @@ def _parse_sheet_new(xl, sheet_name, master_lut, sdos_lut):
         if pn in sdos_lut:
             tdos = sdos_lut[pn]
         else:
-            hit_t = next((v for k, v in sdos_lut.items() if _n(k) == pn_n), None)
+            hit_t = sdos_by_n.get(pn_n)
             tdos  = hit_t if hit_t else 0
         n_val = int(tdos // 7 + 1) if tdos > 0 else 1
 
@@ -343,10 +366,6 @@ def _parse_sheet_new(xl, sheet_name, master_lut, sdos_lut):
 # =============================================================================
 
 def _run_flash(df):
-    df = df.fillna(0).copy()
-    df["Date"] = pd.to_datetime(df["Date"])
-    df = df.sort_values(by=["Part Number", "Date"]).reset_index(drop=True)
-
     unconf_col   = "SupplierHP(UnconfirmedOrders)"
     conf_col     = "SupplierHP(ConfirmedOrders)"
     deductions   = ["POR demand", "PO vs POR adustment", "Backlog", "Build and Hold",
@@ -355,51 +374,71 @@ def _run_flash(df):
     forward_cols = ["POR demand", "PO vs POR adustment", "Backlog", "Build and Hold",
                     "Pre-build", "Test Req't"]
 
-    final_results = []
-    for part, group in df.groupby("Part Number"):
-        records      = group.to_dict("records")
-        num_rows     = len(records)
-        prev_balance = None
-
-        for i in range(num_rows):
-            row         = records[i]
-            moq         = max(float(row.get("MOQ", 1)), 1)
-            n_weeks     = int(row.get("n", 5))
-            start_val   = float(row.get("Onhand", 0)) if i == 0 else prev_balance
-            current_ded = sum(float(row.get(c, 0)) for c in deductions if c in row)
-            c_val       = float(row[conf_col])
-
-            if i + n_weeks < num_rows:
-                target_sum = sum(
-                    sum(float(records[j].get(c, 0)) for c in forward_cols if c in records[j])
-                    for j in range(i+1, i+1+n_weeks)
-                )
-                base_bal        = start_val + c_val - current_ded
-                k               = math.floor((target_sum - base_bal) / moq) + 1
-                row[unconf_col] = k * moq
-
-            final_supply          = float(row[unconf_col]) + c_val
-            this_week_balance     = start_val + final_supply - current_ded
-            row["Calculated_Balance"] = this_week_balance
-            prev_balance          = this_week_balance
-
-            if i + n_weeks < num_rows:
-                future_sum = sum(
-                    sum(float(records[j].get(c, 0)) for c in forward_cols if c in records[j])
-                    for j in range(i+1, i+1+n_weeks)
-                )
-                row["WOS"] = (this_week_balance / future_sum) * n_weeks if future_sum > 0 else 999
+    df = df.assign(Date=_as_datetime(df["Date"]))
+    df = df.sort_values(by=["Part Number", "Date"]).reset_index(drop=True)
+
+    # Demand columns missing from the sheet count as zero
+    ded_present = [c for c in deductions if c in df.columns]
+    fwd_present = [c for c in forward_cols if c in df.columns]
+
+    # Zero-fill only the numeric inputs of the recurrence; sort_values already
+    # gave us a private copy, so no whole-frame fillna pass is needed.
+    numeric_cols = list(dict.fromkeys(ded_present + fwd_present +
+                                      [conf_col, unconf_col, "MOQ", "n", "Onhand"]))
+    df[numeric_cols] = df[numeric_cols].fillna(0)
+
+    # Structure-of-arrays: one contiguous float64 column per input, sliced per
+    # part. Quantities can be decimals, and float32 rounding is enough to tip
+    # the MOQ ceiling into another batch, so everything stays float64.
+    arrs = {c: df[c].to_numpy(dtype=np.float64, copy=True)
+            for c in [conf_col, unconf_col, "MOQ", "Onhand"]}
+    n_all       = df["n"].to_numpy(dtype=np.int64)
+    ded_all     = df[ded_present].to_numpy(dtype=np.float64).sum(axis=1)
+    fwd_all     = df[fwd_present].to_numpy(dtype=np.float64).sum(axis=1)
+    moq_all     = np.maximum(arrs["MOQ"], 1.0)
+    unconf_out  = arrs[unconf_col]
+    bal_out     = np.empty(len(df))
+    wos_out     = np.full(len(df), np.nan)
+
+    # df is sorted by part, so each group is a contiguous run of rows and the
+    # kernel can write straight into views of the output arrays.
+    pn      = df["Part Number"]
+    starts  = np.flatnonzero((pn != pn.shift()).to_numpy())
+    offsets = np.append(starts, len(df)).astype(np.int64)
+    compute_all(
+        offsets, arrs["Onhand"], arrs[conf_col], ded_all, fwd_all,
+        moq_all, n_all, unconf_out, bal_out, wos_out,
+    )
 
-        final_results.extend(records)
-    return pd.DataFrame(final_results)
+    df[unconf_col]           = unconf_out
+    df["Calculated_Balance"] = bal_out
+    df["WOS"]                = wos_out
+    return df
 
 # =============================================================================
 # STEP 4 — Full pipeline: parse ALL MPA sheets + Flash + All MPA
 # =============================================================================
 
+@st.cache_data(show_spinner=False, max_entries=4, ttl="1h")
 def build_all_results(file_bytes):
-    xl         = pd.ExcelFile(BytesIO(file_bytes))
-    master_lut = _load_master(xl)
+    """
+    Parse and process every MPA sheet. Returns (sheet_dict, stats_dict,
+    master_df), where master_df is the Master sheet with its header row, for
+    the price lookup in the UI (None if there is no Master sheet).
+    """
+    xl = pd.ExcelFile(BytesIO(file_bytes), engine="calamine")
+
+    # Each sheet is parsed at most once, and only if the pipeline needs it.
+    def _raw(candidates):
+        sheet = _find_sheet(xl.sheet_names, candidates)
+        return xl.parse(sheet, header=None) if sheet else None
+
+    master_df  = _master_frame(_raw(["Master", "MASTER", "master"]))
+    master_lut = _load_master(master_df)
+    if master_df is not None:
+        # Numeric dtypes for the UI, as a headed read_excel would give
+        master_df = master_df.infer_objects()
+    sdos_raw   = None
 
     sheet_dict = {}
     stats_dict = {}
@@ -409,16 +448,20 @@ def build_all_results(file_bytes):
         if src is None:
             continue
 
-        # Parse to get the first date (needed for TDOS target)
-        first_data_date = _parse_sheet_new_nodates(xl, src)
+        raw = xl.parse(src, header=None)
+
+        # First date decides which SDOS column to use for TDOS
+        first_data_date = _parse_sheet_new_nodates(raw)
         if first_data_date is None:
             continue
 
         # Now load SDOS with the correct target date
-        sdos_lut = _load_sdos(xl, first_data_date)
+        if sdos_raw is None:
+            sdos_raw = _raw(["SDOS", "sdos"])
+        sdos_lut = _load_sdos(sdos_raw, first_data_date)
 
         # Full parse
-        df = _parse_sheet_new(xl, src, master_lut, sdos_lut)
+        df = _parse_sheet_new(raw, master_lut, sdos_lut)
         if df.empty:
             continue
 
@@ -444,17 +487,16 @@ def build_all_results(file_bytes):
             "tdos_date":   "",
         }
 
-    return sheet_dict, stats_dict
+    return sheet_dict, stats_dict, master_df
 
 
-def _parse_sheet_new_nodates(xl, sheet_name):
+def _parse_sheet_new_nodates(raw):
     """
     Lightweight helper: just return the first data date in a new-format sheet,
     so we can decide which SDOS column to use before full parsing.
     Returns a pd.Timestamp or None.
     """
     try:
-        raw = xl.parse(sheet_name, header=None)
         header_rows = [r for r in range(len(raw))
                        if str(raw.iloc[r, 0]).strip() == "MPA"]
         if not header_rows:
@@ -469,17 +511,39 @@ def _parse_sheet_new_nodates(xl, sheet_name):
     return None
 
 # =============================================================================
-# UI  (original app.py structure, preserved)
+# STEP 5 — Excel export
 # =============================================================================
 
-def get_last_monday_of_month(year, month):
-    if month == 12:
-        last_day = datetime(year+1, 1, 1).toordinal() - 1
-    else:
-        last_day = datetime(year, month+1, 1).toordinal() - 1
-    last_date = datetime.fromordinal(last_day)
-    return (last_date - timedelta(days=last_date.weekday())).date()
+def write_results_xlsx(sheet_dict, output):
+    """
+    Write every result sheet to `output` (path or binary file object) with
+    xlsxwriter in constant_memory mode, so only the current row is held in
+    memory. That mode drops cells written to earlier rows, and
+    DataFrame.to_excel writes column by column, so rows are written here.
+    """
+    wb         = xlsxwriter.Workbook(output, {"constant_memory": True})
+    header_fmt = wb.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    date_fmt   = wb.add_format({"num_format": "YYYY-MM-DD HH:MM:SS"})
+
+    for name, df in sheet_dict.items():
+        ws = wb.add_worksheet(name)
+        ws.write_row(0, 0, [str(c) for c in df.columns], header_fmt)
+        for r, row in enumerate(df.itertuples(index=False, name=None), start=1):
+            for c, v in enumerate(row):
+                if pd.isna(v):
+                    continue
+                if isinstance(v, datetime):
+                    ws.write_datetime(r, c, v, date_fmt)
+                elif isinstance(v, (float, np.floating)) and math.isinf(v):
+                    # xlsxwriter rejects inf; write it as text like to_excel's inf_rep
+                    ws.write_string(r, c, "inf" if v > 0 else "-inf")
+                else:
+                    ws.write(r, c, v)
+    wb.close()
 
+# =============================================================================
+# UI  (original app.py structure, preserved)
+# =============================================================================
 
 st.title("📈 HOI Flash Quarterly Inventory Projection")
 
@@ -489,11 +553,13 @@ if uploaded_file:
     file_key = f"{uploaded_file.name}_{uploaded_file.size}"
     if st.session_state.get("_file_key") != file_key:
         with st.spinner("⚙️ Processing all sheets…"):
-            file_bytes = uploaded_file.read()
-            sheet_dict, stats_dict = build_all_results(file_bytes)
+            file_bytes = uploaded_file.getvalue()
+            sheet_dict, stats_dict, master_df = build_all_results(file_bytes)
+        st.session_state.pop("_xlsx_bytes", None)
         st.session_state["_file_key"]   = file_key
         st.session_state["_sheet_dict"] = sheet_dict
         st.session_state["_stats_dict"] = stats_dict
+        st.session_state["_master_df"]  = master_df
 
     sheet_dict = st.session_state["_sheet_dict"]
     stats_dict = st.session_state["_stats_dict"]
@@ -522,35 +588,37 @@ if uploaded_file:
         st.dataframe(sheet_dict[selected_sheet].head(100), use_container_width=True)
 
     with tab2:
-        xl_check = pd.ExcelFile(BytesIO(uploaded_file.getvalue()))
-        master_sheet = _find_sheet(xl_check.sheet_names, ["Master", "MASTER", "master"])
-        if master_sheet:
-            master_df      = xl_check.parse(master_sheet)
+        master_df = st.session_state["_master_df"]
+        if master_df is not None:
             price_col_list = [c for c in master_df.columns if "Cost" in str(c)]
             if price_col_list:
                 price_col    = price_col_list[0]
-                price_lookup = master_df.set_index("HPPN")[price_col].to_dict()
-                opt_df = sheet_dict[selected_sheet].copy()
-                opt_df["Date"]      = pd.to_datetime(opt_df["Date"])
-                opt_df["Date_Only"] = opt_df["Date"].dt.date
-                years_months  = opt_df["Date"].dt.to_period("M").unique()
-                target_dates  = [get_last_monday_of_month(ym.year, ym.month)
-                                  for ym in years_months]
-                summary_rows = []
-                for part, group in opt_df.groupby("Part Number"):
-                    unit_price = price_lookup.get(part, 0)
-                    for t_date in target_dates:
-                        match = group[group["Date_Only"] == t_date]
-                        bal   = match["Calculated_Balance"].iloc[0] if not match.empty else 0
-                        summary_rows.append({
-                            "Part Number":   part,
-                            "Snapshot Date": t_date,
-                            "Month":         t_date.strftime("%Y-%m"),
-                            "Balance":       bal,
-                            "Unit Price":    unit_price,
-                            "Amount":        bal * unit_price,
-                        })
-                summary_df = pd.DataFrame(summary_rows)
+                unit_prices  = master_df.set_index("HPPN")[price_col]
+                # Last duplicate HPPN wins, as with the old dict lookup
+                unit_prices  = unit_prices[~unit_prices.index.duplicated(keep="last")]
+                opt_df = sheet_dict[selected_sheet]
+                # Midnight-normalised datetime64 keys; no per-row date objects
+                day = _as_datetime(opt_df["Date"]).dt.normalize()
+                # Snapshot = last Monday of each month present in the data
+                years_months = pd.PeriodIndex(day.dt.to_period("M").unique())
+                month_ends   = years_months.to_timestamp(how="end").normalize()
+                target_ts    = month_ends - pd.to_timedelta(month_ends.weekday, unit="D")
+                # Part × snapshot grid, left-joined to the first balance on each date
+                on_snap = day.isin(target_ts)
+                snap = (pd.DataFrame({"Part Number":   opt_df["Part Number"][on_snap],
+                                      "Snapshot Date": day[on_snap],
+                                      "Balance":       opt_df["Calculated_Balance"][on_snap]})
+                          .drop_duplicates(["Part Number", "Snapshot Date"]))
+                grid = pd.MultiIndex.from_product(
+                    [opt_df["Part Number"].drop_duplicates().sort_values(), target_ts],
+                    names=["Part Number", "Snapshot Date"],
+                ).to_frame(index=False)
+                summary_df = grid.merge(snap, how="left", on=["Part Number", "Snapshot Date"])
+                summary_df["Balance"] = summary_df["Balance"].fillna(0)
+                summary_df.insert(2, "Month", summary_df["Snapshot Date"].dt.strftime("%Y-%m"))
+                summary_df["Snapshot Date"] = summary_df["Snapshot Date"].dt.date
+                summary_df["Unit Price"] = summary_df["Part Number"].map(unit_prices).fillna(0)
+                summary_df["Amount"]     = summary_df["Balance"] * summary_df["Unit Price"]
                 st.markdown("### 🔍 Financial Analysis Filters")
                 available_months = sorted(summary_df["Month"].unique())
                 selected_months  = st.multiselect(
@@ -572,16 +640,22 @@ if uploaded_file:
             st.warning("Master sheet not found.")
 
     st.divider()
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        for name, df_to_save in sheet_dict.items():
-            df_to_save.to_excel(writer, index=False, sheet_name=name)
-    st.download_button(
-        "📥 Download Final Excel",
-        data=output.getvalue(),
-        file_name=f"WOS_Audited_{uploaded_file.name}",
-        use_container_width=True,
-    )
+    # Build the workbook only on request and only once per upload; the bytes
+    # live in session state, so they go away with the session or the next upload.
+    xlsx_bytes = st.session_state.get("_xlsx_bytes")
+    if xlsx_bytes is None and st.button("📦 Prepare Final Excel", use_container_width=True):
+        with st.spinner("Writing workbook…"):
+            output = BytesIO()
+            write_results_xlsx(sheet_dict, output)
+        st.session_state["_xlsx_bytes"] = xlsx_bytes = output.getvalue()
+
+    if xlsx_bytes is not None:
+        st.download_button(
+            "📥 Download Final Excel",
+            data=xlsx_bytes,
+            file_name=f"WOS_Audited_{uploaded_file.name}",
+            use_container_width=True,
+        )
 
 else:
     st.info("Please upload an Excel file and click 'Process Data' in the sidebar.")
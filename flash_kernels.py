@@ -0,0 +1,89 @@
+import math
+import threading
+import numba
+import numpy as np
+import streamlit as st
+from numba import njit, prange
+
+# =============================================================================
+# Flash recurrence kernels
+#
+# Kept out of app.py on purpose: numba's on-disk cache records the defining
+# module and re-imports it when loading an entry. app.py is a Streamlit
+# script, and re-importing it would re-run the whole UI inside the session.
+# =============================================================================
+
+@njit(cache=True)
+def compute_part(onhand, conf, ded, fwd_cum, moq, n_weeks, unconf, balance, wos):
+    """
+    Sequential part of the Flash recurrence for one part (rows sorted by Date).
+    fwd_cum[j] = sum of forward demand over rows [0, j), so the n-week window
+    after row i is fwd_cum[i+1+n] - fwd_cum[i+1].
+    Unconfirmed orders are the fewest whole MOQ batches that bring the balance
+    up to that window's demand: ceil(gap / MOQ), and none when the balance
+    already covers it (gap <= 0).
+    Writes in place: unconf (in/out), balance and wos (out, wos left as-is
+    where the forward window runs past the data).
+    """
+    num_rows     = conf.shape[0]
+    prev_balance = float(onhand)
+
+    for i in range(num_rows):
+        start_val  = prev_balance
+        has_window = i + n_weeks[i] < num_rows
+        # Same n-week forward demand drives the unconfirmed solve and WOS
+        target_sum = fwd_cum[i + 1 + n_weeks[i]] - fwd_cum[i + 1] if has_window else 0.0
+
+        if has_window:
+            gap           = target_sum - (start_val + conf[i] - ded[i])
+            k             = max(0.0, math.ceil(gap / moq[i]))
+            unconf[i]     = k * moq[i]
+
+        this_week_balance = start_val + unconf[i] + conf[i] - ded[i]
+        balance[i]        = this_week_balance
+        prev_balance      = this_week_balance
+
+        if has_window:
+            wos[i] = (this_week_balance / target_sum) * n_weeks[i] if target_sum > 0 else 999.0
+
+
+@njit(parallel=True, cache=True)
+def _compute_all(offsets, onhand, conf, ded, fwd, moq, n_weeks, unconf, balance, wos):
+    """
+    Run compute_part for every part across cores. Rows are sorted by part and
+    part g owns rows [offsets[g], offsets[g+1]), so parts write disjoint slices.
+    """
+    for g in prange(offsets.shape[0] - 1):
+        start   = offsets[g]
+        stop    = offsets[g + 1]
+        fwd_cum = np.empty(stop - start + 1)
+        fwd_cum[0] = 0.0
+        for j in range(start, stop):
+            fwd_cum[j - start + 1] = fwd_cum[j - start] + fwd[j]
+        compute_part(
+            onhand[start], conf[start:stop], ded[start:stop], fwd_cum,
+            moq[start:stop], n_weeks[start:stop],
+            unconf[start:stop], balance[start:stop], wos[start:stop],
+        )
+
+
+@st.cache_resource(show_spinner=False)
+def _lock():
+    """
+    Process-wide lock around _compute_all. cache_resource hands every session
+    the same one, even after Streamlit reloads this module on a file change.
+    Streamlit runs scripts in worker threads, and a TBB pool started from a
+    non-main thread can hang interpreter shutdown, so OpenMP/workqueue are
+    preferred. workqueue cannot run two parallel kernels at once, hence the lock.
+    """
+    numba.config.THREADING_LAYER_PRIORITY = ["omp", "workqueue", "tbb"]
+    return threading.Lock()
+
+
+def compute_all(offsets, onhand, conf, ded, fwd, moq, n_weeks, unconf, balance, wos):
+    """
+    Run the Flash recurrence for every part (see _compute_all), one call at a
+    time per process.
+    """
+    with _lock():
+        _compute_all(offsets, onhand, conf, ded, fwd, moq, n_weeks, unconf, balance, wos)
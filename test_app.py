@@ -0,0 +1,67 @@
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+import app
+
+UNCONF = "SupplierHP(UnconfirmedOrders)"
+CONF   = "SupplierHP(ConfirmedOrders)"
+
+
+def _part(pn, onhand, moq, n, demand, conf, unconf):
+    dates = pd.date_range("2025-01-06", periods=len(demand), freq="W-MON")
+    return pd.DataFrame({
+        "Part Number": pn, "Date": dates, "MOQ": moq, "n": n, "Onhand": onhand,
+        "POR demand": demand, CONF: conf, UNCONF: unconf,
+    })
+
+
+def test_unconfirmed_orders_are_ceil_of_gap_over_moq():
+    # Only "POR demand" is present: it is both a deduction and forward demand,
+    # every other demand column is missing and counts as zero.
+    df = pd.concat([
+        _part("A", onhand=100.0, moq=10.0, n=1,
+              demand=[50.0, 120.0, 21.0, 5.0, 7.0],
+              conf=[0.0, 0.0, 40.0, 0.0, 0.0],
+              unconf=[0.0, 0.0, 0.0, 0.0, 3.0]),
+        _part("B", onhand=10.0, moq=10.0, n=5,
+              demand=[1.0, 2.0], conf=[0.0, 0.0], unconf=[4.0, 0.0]),
+    ], ignore_index=True)
+
+    out = app._run_flash(df)
+
+    # A0: base 100-50=50,   target 120, gap 70 == 7*MOQ   -> 7 batches (old rule: 8)
+    # A1: base 120-120=0,   target 21,  gap 21 just above  -> 3 batches
+    # A2: base 30+40-21=49, target 5,   gap -44 < 0        -> 0          (old rule: -40)
+    # A3: base 49-5=44,     target 7,   gap -37 < 0        -> 0
+    # A4: window runs past the data    -> unconfirmed left as given (3)
+    # B:  n=5 window runs past both rows -> unconfirmed left as given
+    np.testing.assert_array_equal(out[UNCONF], [70, 30, 0, 0, 3, 4, 0])
+    np.testing.assert_array_equal(out["Calculated_Balance"], [120, 30, 49, 44, 40, 13, 11])
+    np.testing.assert_allclose(out["WOS"], [1.0, 30 / 21, 49 / 5, 44 / 7, np.nan, np.nan, np.nan])
+
+
+def test_results_xlsx_matches_to_excel():
+    df = pd.DataFrame({
+        "Part Number": ["A", None, "C", "D"],
+        "Date":        [pd.Timestamp("2025-01-06"), pd.Timestamp("2025-01-13 08:30"),
+                        pd.NaT, pd.Timestamp("2025-02-03")],
+        "WOS":         [1.5, np.nan, np.inf, -np.inf],
+        "n":           [1, 2, 3, 4],
+        "Mixed":       ["x", 2.5, None, np.nan],
+    })
+    sheets = {"FXN 2X": df, "All MPA": df.iloc[::-1]}
+
+    got = BytesIO()
+    app.write_results_xlsx(sheets, got)
+    want = BytesIO()
+    with pd.ExcelWriter(want, engine="xlsxwriter") as writer:
+        for name, frame in sheets.items():
+            frame.to_excel(writer, sheet_name=name, index=False)
+
+    got  = pd.read_excel(got, sheet_name=None, engine="calamine")
+    want = pd.read_excel(want, sheet_name=None, engine="calamine")
+    assert list(got) == list(sheets)
+    for name in sheets:
+        pd.testing.assert_frame_equal(got[name], want[name])